@@ -21,9 +21,15 @@
 #
 
 import argparse
+import functools
+import http.client
+import io
+import itertools
 import math
 import json
+import operator
 import re
+import string
 import subprocess
 import sys
 import time
@@ -32,45 +38,68 @@ import urllib.request
 import urllib.parse
 import yaml
 
-from typing import Optional
-from collections import namedtuple
+from array import array
+from typing import Iterable, Iterator, Optional
+from collections import Counter, namedtuple
+
+# use the libyaml based loader if pyyaml was built with it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+# parse lines like:
+# rest_api_scheduler_queue_length{group="main",shard="0"} 0.000000
+# where:
+#   - "rest_api" is the prometheus prefix
+#   - "scheduler" is the metric group name
+#   - "queue_length" is the name of the metric
+#   - the kv pairs in "{}" are labels"
+#   - "0.000000" is the value of the metric
+# this format is compatible with
+# https://github.com/prometheus/docs/blob/main/content/docs/instrumenting/exposition_formats.md
+# NOTE: scylla does not include timestamp in the exported metrics
+SAMPLE_PATTERN = re.compile(rb'''(?P<metric_name>\w+)   # rest_api_scheduler_queue_length
+                               \{(?P<labels>[^\}]*)\} # {group="main",shard="0"}
+                               \s+                    # <space>
+                               (?P<value>[^\s]+)      # 0.000000''', re.X)
+# the characters matched by "\w" in SAMPLE_PATTERN, used to validate the
+# metric names without the regex
+METRIC_NAME_CHARS = frozenset(string.ascii_letters.encode() +
+                              string.digits.encode() +
+                              b'_')
 
 
 class Exposition:
     @classmethod
     def from_hist(cls,
                   name: str,
-                  hist: list[tuple[float, int]],
-                  sum_: int,
-                  count: int) -> 'Exposition':
+                  hist: list[tuple[float, float]],
+                  sum_: float,
+                  count: float) -> 'Exposition':
         # ignore these values, we might need to verify them in future
         _, _ = sum_, count
-        buckets = (cls.value_to_bucket(le - 1) for le, _ in hist)
-        deltas = []
-        last_n = 0
-        for _, n in hist:
-            delta = n - last_n
-            last_n = n
-            deltas.append(delta)
-        return cls(name, dict(zip(buckets, deltas)), {})
+        edges = array('d', (cls.value_to_bucket(le - 1) for le, _ in hist))
+        # the buckets are cumulative and ordered by "le", so the count of
+        # each bucket is its difference from the previous one
+        totals = [n for _, n in hist]
+        counts = array('d', map(operator.sub, totals, itertools.chain((0,), totals)))
+        return cls(name, None, {}, edges=edges, counts=counts)
 
     @staticmethod
-    def value_to_bucket(value):
-        low = 2 ** math.floor(math.log(value, 2))
+    @functools.lru_cache(maxsize=2048)
+    def value_to_bucket(value: float) -> float:
+        if value < 1:
+            low = 2 ** math.floor(math.log(value, 2))
+        else:
+            # floor(log2(value)) is the bit length of its integral part
+            # minus one, no need to go through the floating point log()
+            low = 1 << (int(value).bit_length() - 1)
         high = 2 * low
         dif = (high - low) / 4
         return low + dif * math.floor((value - low) / dif)
 
     @staticmethod
-    def _values_to_histogram(values):
-        hist = {}
-        for val in values:
-            bucket = Exposition.value_to_bucket(val)
-            if bucket in hist:
-                hist[bucket] += 1
-            else:
-                hist[bucket] = 1
-        return hist
+    def _values_to_histogram(values: Iterable[float]) -> dict[float, int]:
+        return dict(Counter(map(Exposition.value_to_bucket, values)))
 
     @classmethod
     def from_conf(cls,
@@ -83,47 +112,61 @@ class Exposition:
             return cls(name, float(values[0]), labels)
         if type_ == 'histogram':
             hist = cls._values_to_histogram(float(v) for v in values)
-            return cls(name, hist, {})
+            edges = sorted(hist)
+            return cls(name, None, {},
+                       edges=array('d', edges),
+                       counts=array('d', map(hist.__getitem__, edges)))
         raise NotImplementedError(f'unsupported type: {type_}')
 
     def __init__(self,
                  name: str,
-                 value: int | list[tuple[float, int]],
-                 labels: dict[str, str]) -> None:
+                 value: Optional[float],
+                 labels: dict[str, str],
+                 *,
+                 edges: Optional[array] = None,
+                 counts: Optional[array] = None) -> None:
         self.name = name
+        # None for a histogram, which is kept as two parallel arrays of the
+        # bucket edges and their counts instead, ordered by the edges
         self.value = value
         self.labels = labels
+        self.edges = edges
+        self.counts = counts
+
+    def as_dict(self) -> dict[float, float]:
+        '''return the histogram as a dict of bucket edge to count
+        '''
+        assert self.edges is not None and self.counts is not None
+        return dict(zip(self.edges, self.counts))
 
-    def __repr__(self):
+    def __repr__(self) -> str:
+        if self.edges is not None:
+            return f"{self.name=}, {self.as_dict()=}, {self.labels=}"
         return f"{self.name=}, {self.value=}, {self.labels=}"
 
-    def __eq__(self, other):
+    def __eq__(self, other: object) -> bool:
         if not isinstance(other, Exposition):
             return False
-        return self.value == other.value
+        return (self.value == other.value and
+                self.edges == other.edges and
+                self.counts == other.counts)
 
 
 class Metrics:
     prefix = 'seastar'
     group = 'test_group'
-    # parse lines like:
-    # rest_api_scheduler_queue_length{group="main",shard="0"} 0.000000
-    # where:
-    #   - "rest_api" is the prometheus prefix
-    #   - "scheduler" is the metric group name
-    #   - "queue_length" is the name of the metric
-    #   - the kv pairs in "{}" are labels"
-    #   - "0.000000" is the value of the metric
-    # this format is compatible with
-    # https://github.com/prometheus/docs/blob/main/content/docs/instrumenting/exposition_formats.md
-    # NOTE: scylla does not include timestamp in the exported metrics
-    pattern = re.compile(r'''(?P<metric_name>\w+)   # rest_api_scheduler_queue_length
-                             \{(?P<labels>[^\}]*)\} # {group="main",shard="0"}
-                             \s+                    # <space>
-                             (?P<value>[^\s]+)      # 0.000000''', re.X)
-
-    def __init__(self, lines: list[str]) -> None:
-        self.lines: list[str] = lines
+
+    def __init__(self, body: bytes) -> None:
+        # the body is not decoded as a whole: the names and values are
+        # compared and parsed as bytes, while the labels, whose values can
+        # be any UTF-8, are decoded per sample
+        self.body: bytes = body
+
+    @property
+    def lines(self) -> Iterator[bytes]:
+        '''iterate over the lines in the body without splitting all of them
+        '''
+        return (line.rstrip(b'\n') for line in io.BytesIO(self.body))
 
     @classmethod
     def full_name(cls, name: str) -> str:
@@ -131,33 +174,58 @@ class Metrics:
         '''
         return f'{cls.group}_{name}'
 
+    @staticmethod
+    def _match_sample(line: bytes) -> tuple[bytes, bytes, bytes]:
+        '''split a sample line not formatted like "name{labels} value" into
+        its name, labels and value
+        '''
+        matched = SAMPLE_PATTERN.match(line)
+        assert matched, f'malformed metric line: {line!r}'
+        name, labels, value = matched.group('metric_name', 'labels', 'value')
+        return name, labels, value
+
     @staticmethod
     def _parse_labels(s: str) -> dict[str, str]:
-        return dict(name_value.split('=', 1) for name_value in s.split(','))
+        labels: dict[str, str] = {}
+        if not s:
+            return labels
+        for name_value in s.split(','):
+            # unlike split('=', 1), partition() does not build a list
+            name, eq, value = name_value.partition('=')
+            if not eq:
+                raise ValueError(f'malformed labels: {s}')
+            labels[name] = value
+        return labels
 
     def get(self,
             name: Optional[str] = None,
-            labels: Optional[dict[str, str]] = None) -> list[Exposition]:
+            labels: Optional[dict[str, str]] = None) -> Iterator[Exposition]:
         '''Return all expositions matching the given name and labels
         '''
-        full_name = None
+        name_prefix = None
         if name is not None:
-            full_name = f'{self.prefix}_{self.group}_{name}'
-        metric_type = None
+            name_prefix = f'{self.prefix}_{self.group}_{name}'.encode()
+        metric_type: Optional[str] = None
 
         # for histogram and summary as they are represented with multiple lines
         hist_name = ''
-        hist_buckets = []
-        hist_sum = 0
-        hist_count = 0
+        hist_bucket_name = b''
+        hist_sum_name = b''
+        hist_count_name = b''
+        hist_buckets: list[tuple[float, float]] = []
+        hist_sum = 0.0
+        hist_count = 0.0
 
         for line in self.lines:
             if not line:
                 continue
-            if line.startswith('# HELP'):
-                continue
-            if line.startswith('# TYPE'):
-                _, _, type_metric_name, metric_type = line.split()
+            # check for the "# HELP" and "# TYPE" lines only if the line is
+            # a comment, so a sample line pays a single startswith()
+            if line.startswith(b'#'):
+                if line.startswith(b'# HELP'):
+                    continue
+                assert line.startswith(b'# TYPE'), f'malformed metric line: {line!r}'
+                _, _, type_metric_name, metric_type = line.decode().split()
                 if hist_buckets:
                     yield Exposition.from_hist(hist_name,
                                                hist_buckets,
@@ -166,33 +234,55 @@ class Metrics:
                     hist_buckets = []
                 if metric_type in ('histogram', 'summary'):
                     hist_name = type_metric_name
+                    hist_bucket_name = f'{type_metric_name}_bucket'.encode()
+                    hist_sum_name = f'{type_metric_name}_sum'.encode()
+                    hist_count_name = f'{type_metric_name}_count'.encode()
                 continue
-            matched = self.pattern.match(line)
-            assert matched, f'malformed metric line: {line}'
-
-            value_metric_name = matched.group('metric_name')
-            if full_name and not value_metric_name.startswith(full_name):
+            # all samples of the metric, including the suffixed ones, start
+            # with its full name, so reject the others before parsing them
+            if name_prefix and not line.startswith(name_prefix):
+                continue
+            # seastar always formats the samples like "name{labels} value",
+            # so locate the braces instead of matching the line with
+            # SAMPLE_PATTERN, which is reserved for the other lines
+            brace = line.find(b'{')
+            end = line.find(b'}', brace + 1)
+            value_metric_name = line[:brace]
+            # the samples without a value or with a timestamp are left to
+            # SAMPLE_PATTERN as well
+            if (brace > 0 and end > 0 and line.startswith(b' ', end + 1) and
+                    len(line) > end + 2 and line.find(b' ', end + 2) < 0 and
+                    METRIC_NAME_CHARS.issuperset(value_metric_name)):
+                raw_labels = line[brace + 1:end]
+                raw_value = line[end + 2:]
+            else:
+                value_metric_name, raw_labels, raw_value = self._match_sample(line)
+            # only the histogram and summary samples carry a suffix
+            if (name_prefix and
+                    metric_type not in ('histogram', 'summary') and
+                    value_metric_name != name_prefix):
                 continue
 
-            metric_labels = self._parse_labels(matched.group('labels'))
+            metric_labels = self._parse_labels(raw_labels.decode())
             if labels is not None and metric_labels != labels:
                 continue
 
-            metric_value = float(matched.group('value'))
+            # float() parses the ASCII digits in bytes as well
+            metric_value = float(raw_value)
             if metric_type == 'histogram':
-                if value_metric_name == f'{type_metric_name}_bucket':
-                    last_value = 0
+                if value_metric_name == hist_bucket_name:
+                    last_value = 0.0
                     if hist_buckets:
                         last_value = hist_buckets[-1][1]
                     if metric_value - last_value != 0:
                         le = metric_labels['le'].strip('"')
                         hist_buckets.append((float(le), metric_value))
-                elif value_metric_name == f'{type_metric_name}_sum':
+                elif value_metric_name == hist_sum_name:
                     hist_sum = metric_value
-                elif value_metric_name == f'{type_metric_name}_count':
+                elif value_metric_name == hist_count_name:
                     hist_count = metric_value
                 else:
-                    raise RuntimeError(f'unknown histogram value: {line}')
+                    raise RuntimeError(f'unknown histogram value: {line!r}')
             elif metric_type == 'summary':
                 raise NotImplementedError('unsupported type: summary')
             else:
@@ -205,13 +295,31 @@ class Metrics:
                                        hist_sum,
                                        hist_count)
 
+    def get_simple(self, name: str) -> Iterator[Exposition]:
+        '''Return all expositions of the given gauge or counter
+
+        unlike get(), the labels are not parsed, and histograms and summaries
+        are not supported
+        '''
+        full_name = f'{self.prefix}_{self.group}_{name}'
+        type_header = f'# TYPE {full_name} '.encode()
+        prefix = f'{full_name}{{'.encode()
+        for line in self.lines:
+            if line.startswith(type_header):
+                metric_type = line[len(type_header):].decode()
+                if metric_type not in ('gauge', 'counter'):
+                    raise NotImplementedError(f'unsupported type: {metric_type}')
+            elif line.startswith(prefix):
+                _, _, value = line.rpartition(b' ')
+                yield Exposition(full_name, float(value), {})
+
     def get_help(self, name: str) -> Optional[str]:
         full_name = f'{self.prefix}_{self.group}_{name}'
-        header = f'# HELP {full_name}'
+        header = f'# HELP {full_name}'.encode()
         for line in self.lines:
             if line.startswith(header):
                 tokens = line.split(maxsplit=3)
-                return tokens[-1]
+                return tokens[-1].decode()
         return None
 
 
@@ -219,6 +327,7 @@ class TestPrometheus(unittest.TestCase):
     exporter_path = None
     exporter_process = None
     exporter_config = None
+    exporter_connection = None
     port = 10001
     prometheus = None
     prometheus_scrape_interval = 15
@@ -235,9 +344,13 @@ class TestPrometheus(unittest.TestCase):
                                                 bufsize=0, text=True)
         # wait until the server is ready for serve
         cls.exporter_process.stdout.readline()
+        # keep the connection alive, and reuse it for all the scrapes
+        cls.exporter_connection = http.client.HTTPConnection('localhost',
+                                                             cls.port)
 
     @classmethod
     def tearDownClass(cls) -> None:
+        cls.exporter_connection.close()
         cls.exporter_process.terminate()
 
     @classmethod
@@ -256,11 +369,12 @@ class TestPrometheus(unittest.TestCase):
         if not aggregate:
             query['__aggregate__'] = 'false'
         params = urllib.parse.urlencode(query)
-        host = 'localhost'
-        url = f'http://{host}:{cls.port}/metrics?{params}'
-        with urllib.request.urlopen(url) as f:
-            body = f.read().decode('utf-8')
-            return Metrics(body.rstrip().split('\n'))
+        cls.exporter_connection.request('GET', f'/metrics?{params}')
+        response = cls.exporter_connection.getresponse()
+        body = response.read()
+        if response.status != http.HTTPStatus.OK:
+            raise RuntimeError(f'failed to get metrics: {response.status} {response.reason}')
+        return Metrics(body)
 
     def test_filtering_by_label_sans_aggregation(self) -> None:
         labels = {'private': '1'}
@@ -268,7 +382,7 @@ class TestPrometheus(unittest.TestCase):
         actual_values = list(metrics.get())
         expected_values = []
         with open(self.exporter_config, encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=SafeLoader)
         for metric in config['metrics']:
             name = metric['name']
             metric_name = f'{Metrics.prefix}_{Metrics.group}_{name}'
@@ -311,7 +425,12 @@ class TestPrometheus(unittest.TestCase):
                               values=test.expected_values):
                 metrics = self._get_metrics(Metrics.full_name(name), aggregate=test.aggregate)
                 expositions = metrics.get(name)
-                actual_values = sorted(e.value for e in expositions)
+                actual_values = [e.value for e in expositions]
+                actual_values.sort()
+                self.assertEqual(actual_values, test.expected_values)
+                expositions = metrics.get_simple(name)
+                actual_values = [e.value for e in expositions]
+                actual_values.sort()
                 self.assertEqual(actual_values, test.expected_values)
 
     def test_help(self) -> None:
@@ -355,7 +474,7 @@ class TestPrometheus(unittest.TestCase):
         # until prometheus scrapes the server
         time.sleep(self.prometheus_scrape_interval + 1)
         with open(self.exporter_config, encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=SafeLoader)
 
         labels = {'private': '1'}
         for metric in config['metrics']:
@@ -373,7 +492,10 @@ class TestPrometheus(unittest.TestCase):
             res = self._query_prometheus(self.prometheus,
                                          metric_name,
                                          metric_type)
-            self.assertEqual(res, e.value)
+            if metric_type == 'histogram':
+                self.assertEqual(res, e.as_dict())
+            else:
+                self.assertEqual(res, e.value)
 
 
 if __name__ == '__main__':